@@ -1,4 +1,8 @@
 import os
+import cProfile
+import gzip
+import importlib
+import json
 import platform
 import subprocess
 import smtplib
@@ -12,32 +16,162 @@ from email.utils import formataddr
 import requests
 import time
 import socket
+import ssl
+import threading
+import http.client
+import ipaddress
+import random
+import re
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import certifi
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+import heartbeat
+import history
+import tracing
 
 ONLINE = "Online"
 OFFLINE = "Offline"
+UNREACHABLE = "Unreachable (parent down)"  # Not probed because the device's parent is down
 
-sender_email = local_config.sender_email
-sender_name = local_config.sender_name
-receiver_emails = local_config.receiver_emails
-email_password = local_config.email_password
-smtp_server = local_config.smtp_server
-smtp_port = local_config.smtp_port
+# Config key and sheet "Type" of each resource kind, in the order they are checked
+RESOURCE_TYPES = (("urls", "URL"), ("ips", "IP"), ("directories", "Directory"), ("heartbeats", "Heartbeat"))
 
-google_credentials = local_config.google_credentials
-google_sheet_id = local_config.google_sheet_id
-google_sheet_name = local_config.google_sheet_name
-
-devices = local_config.devices
 RESPONSE_TIME_THRESHOLD = 5000
-
+HTTP_TIMEOUT = 5  # Seconds
+DEFAULT_MAX_BODY_BYTES = 1024 * 1024  # Most of a body read for a URL's content assertions
+CONTENT_CHUNK_SIZE = 8192
+REGEX_OVERLAP = 4096  # Bytes a regex match must end before the data read so far to pass early
+CERTIFICATE_WARNING_INTERVAL = 24 * 3600  # Seconds before an expiring certificate is emailed about again
+HEARTBEAT_WINDOW = 300  # Seconds without a beat before a heartbeat target is Offline, unless set per target
+SUBNET_PREFIX_V6 = 64
+SNAPSHOT_VERSION = 1
+
+# Netlink constants for dumping the kernel neighbor (ARP/NDP) table, see rtnetlink(7)
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NDA_DST = 1
+NUD_REACHABLE = 0x02
+NLMSG_HEADER = struct.Struct("=LHHLL")
+NDMSG = struct.Struct("=BxxxiHBB")
+RTATTR = struct.Struct("=HH")
+HISTORY_HEADERS = ["Timestamp", "Device Name", "Resource", "Type", "Status", "Response Time (ms)"]
+
+
+def load_config():
+    """Read the settings from local_config into module globals (at import and on every reload)."""
+    global sender_email, sender_name, receiver_emails, email_password, smtp_server, smtp_port
+    global google_credentials, google_sheet_id, google_sheet_name, devices
+    global cert_expiry_warning_days, heartbeat_secret
+    global probe_workers, max_probes_per_host, max_probes_per_subnet, probes_per_host_per_second
+    global subnet_prefix_v4, probe_spread, passive_presence
+    global backoff_after, backoff_max_interval, backoff_recovery_interval, backoff_probe_timeout
+    global run_lock_timeout, reuse_results_for
+    global state_dir, run_lock_file, result_cache_file, certificate_warnings_file, recovery_probes_file, snapshot_file, history_dir, history_max_file_bytes, history_sheet_name
+
+    sender_email = local_config.sender_email
+    sender_name = local_config.sender_name
+    receiver_emails = local_config.receiver_emails
+    email_password = local_config.email_password
+    smtp_server = local_config.smtp_server
+    smtp_port = local_config.smtp_port
+
+    google_credentials = local_config.google_credentials
+    google_sheet_id = local_config.google_sheet_id
+    google_sheet_name = local_config.google_sheet_name
+
+    devices = local_config.devices
+    # Warn when a checked URL's TLS certificate expires within this many days
+    cert_expiry_warning_days = getattr(local_config, "cert_expiry_warning_days", 14)
+    # Shared secret agents sign heartbeats with (a heartbeat entry can set its own 'secret')
+    heartbeat_secret = getattr(local_config, "heartbeat_secret", None)
+
+    # Probe engine: how many probes run at once, and how hard a single host or subnet may be hit
+    probe_workers = getattr(local_config, "probe_workers", 16)
+    max_probes_per_host = getattr(local_config, "max_probes_per_host", 2)
+    max_probes_per_subnet = getattr(local_config, "max_probes_per_subnet", 8)
+    probes_per_host_per_second = getattr(local_config, "probes_per_host_per_second", 5)
+    subnet_prefix_v4 = getattr(local_config, "subnet_prefix_v4", 24)
+    # Seconds to spread probe start times over (e.g. most of check_interval), 0 starts them all at once
+    probe_spread = getattr(local_config, "probe_spread", 0)
+    # Treat IPs the kernel's neighbor table has as REACHABLE as Online instead of pinging them (Linux only)
+    passive_presence = getattr(local_config, "passive_presence", False)
+    # Resources Offline for longer than backoff_after seconds are fully checked less and less often (the
+    # gap doubles every check, up to backoff_max_interval); None disables backoff. In between, a cheap
+    # recovery probe (a ping or TCP connect with backoff_probe_timeout) runs every backoff_recovery_interval
+    backoff_after = getattr(local_config, "backoff_after", 3600)
+    backoff_max_interval = getattr(local_config, "backoff_max_interval", 6 * 3600)
+    backoff_recovery_interval = getattr(local_config, "backoff_recovery_interval", 600)
+    backoff_probe_timeout = getattr(local_config, "backoff_probe_timeout", 1)
+    # Only one run probes at a time: a run (e.g. from cron) waits up to run_lock_timeout seconds for
+    # the one in progress to finish, and is skipped if it's still going
+    run_lock_timeout = getattr(local_config, "run_lock_timeout", 600)
+    # A run that had to wait for another (or is started with --reuse-recent) reuses the results the
+    # other run got instead of probing again, if they are younger than this many seconds; 0 disables
+    reuse_results_for = getattr(local_config, "reuse_results_for", 60)
+
+    # Directory for files the monitor keeps between runs
+    state_dir = getattr(local_config, "state_dir",
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), ".device_monitor"))
+    run_lock_file = os.path.join(state_dir, "run.lock")
+    result_cache_file = os.path.join(state_dir, "recent_results.json")
+    certificate_warnings_file = os.path.join(state_dir, "certificate_warnings.json")
+    recovery_probes_file = os.path.join(state_dir, "recovery_probes.json")
+    # Compressed, column-oriented copy of the sheet so a cold start can skip get_all_records()
+    snapshot_file = getattr(local_config, "snapshot_file", os.path.join(state_dir, "sheet_snapshot.json.gz"))
+    # Append-only record of every check result, set to None to disable
+    history_dir = getattr(local_config, "history_dir", os.path.join(state_dir, "history"))
+    history_max_file_bytes = getattr(local_config, "history_max_file_bytes", history.DEFAULT_MAX_FILE_BYTES)
+    # Optional worksheet that also receives one row per check, appended in one call per run
+    history_sheet_name = getattr(local_config, "history_sheet_name", None)
+
+
+load_config()
+config_mtime = os.stat(local_config.__file__).st_mtime_ns
+
+spreadsheet = None
 ws = None
+history_ws = None
+pending_history = []  # Check results of the current run, written out by flush_history()
 cached_records = None  # Cache to store records
 last_cache_time = None  # Time when the cache was last updated
+records_modified_time = None  # Sheet modifiedTime the cached records correspond to
+run_lock_handle = None  # Open lock file while this process holds the run lock
+run_lock_wait_start = None  # When the current run started waiting for the lock, None if it didn't have to
 CACHE_DURATION = 60  # Cache duration in seconds, adjust as needed
 
+# In-memory view of the latest results, read by the status server
+LATENCY_HISTORY_SIZE = 100  # Response times kept per target for latency stats
+TRANSITION_HISTORY_SIZE = 200  # Status changes kept for the status server
+state_lock = threading.Lock()
+state_version = 0  # Bumped on every change so readers can tell when their copy is stale
+target_states = {}
+recent_transitions = deque(maxlen=TRANSITION_HISTORY_SIZE)
+probe_details = {}  # Target id -> extra measurements from the last probe (e.g. HTTP phase timings)
+certificate_warnings = []  # (device, resource, url, days left) for certificates close to expiry this run
+limits_lock = threading.Lock()
+host_semaphores = {}  # Host -> semaphore capping concurrent probes of it
+subnet_semaphores = {}  # Subnet -> semaphore capping concurrent probes into it
+host_next_start = {}  # Host -> earliest time the next probe of it may start
+profile_probes = False  # Set while main.py profiles a run; a cProfile.Profile only sees its own thread
+probe_profilers = []  # Profiles of the probes run on executor threads, merged into the run's profile
+neighbor_states = {}  # IP -> kernel neighbor state bits, read once per run when passive_presence is on
+recovery_probes = {}  # Target id -> time of its last recovery probe while backed off
+unreachable_resources = {}  # Offline root device -> [(device, resource, value)] newly unreachable behind it this run
+
 
 def initialize_log():
-    global ws
+    global ws, spreadsheet
     """Initialize the Google Sheet log if it doesn't exist."""
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
@@ -54,6 +188,7 @@ def initialize_log():
 
     try:
         sh = gc.open_by_key(google_sheet_id)
+        spreadsheet = sh
         try:
             ws = sh.worksheet(google_sheet_name)
             print(f"Worksheet '{google_sheet_name}' found and loaded successfully.")
@@ -93,18 +228,211 @@ def initialize_log():
     return ws
 
 
+def get_sheet_modified_time():
+    """Return the spreadsheet's modifiedTime from the Drive API (a metadata-only request)."""
+    if spreadsheet is None:
+        return None
+    try:
+        with tracing.span("sheets.get_lastUpdateTime", "sheets"):
+            return spreadsheet.get_lastUpdateTime()
+    except Exception as e:
+        print(f"Failed to read the Google Sheet modified time: {e}")
+        return None
+
+
+def load_records_snapshot(modified_time):
+    """Load records from the on-disk snapshot if it was taken at the given sheet modified time."""
+    if not snapshot_file or not modified_time:
+        return None
+
+    try:
+        with gzip.open(snapshot_file, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable sheet snapshot {snapshot_file}: {e}")
+        return None
+
+    if (snapshot.get("version") != SNAPSHOT_VERSION or
+        snapshot.get("sheet_id") != google_sheet_id or
+        snapshot.get("sheet_name") != google_sheet_name or
+        snapshot.get("modified_time") != modified_time):
+        return None
+
+    # Values are stored column by column, zip them back into one dict per row
+    columns = snapshot["columns"]
+    rows = zip(*(snapshot["data"][column] for column in columns))
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def save_records_snapshot():
+    """Write the cached records to disk along with the sheet's current modified time.
+
+    Call this after the run's writes so the stored modified time already includes them;
+    the next run then only downloads the sheet if someone else has edited it since.
+    """
+    global records_modified_time
+
+    if not snapshot_file or cached_records is None:
+        return
+
+    modified_time = get_sheet_modified_time()
+    if modified_time is None:
+        return
+
+    columns = list(cached_records[0].keys()) if cached_records else []
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "sheet_id": google_sheet_id,
+        "sheet_name": google_sheet_name,
+        "modified_time": modified_time,
+        "columns": columns,
+        "data": {column: [record.get(column, "") for record in cached_records] for column in columns},
+    }
+
+    temp_file = snapshot_file + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+        with gzip.open(temp_file, "wt", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(temp_file, snapshot_file)
+        records_modified_time = modified_time
+    except Exception as e:
+        print(f"Failed to save sheet snapshot {snapshot_file}: {e}")
+
+
+def acquire_run_lock(timeout):
+    """Take the lock that lets only one run probe and write at a time, waiting up to timeout seconds.
+
+    Returns False if another run still holds it. The OS drops the lock when its holder exits,
+    so a run that crashed never blocks the ones after it.
+    """
+    global run_lock_handle, run_lock_wait_start
+
+    run_lock_wait_start = None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        lock_file = open(run_lock_file, "a+")
+    except OSError as e:
+        print(f"Running without the run lock, {run_lock_file} can't be opened: {e}")
+        return True
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            run_lock_handle = lock_file
+            return True
+        except OSError:
+            if time.time() >= deadline:
+                lock_file.close()
+                return False
+            if run_lock_wait_start is None:
+                print(f"Another run is in progress, waiting up to {timeout}s for it to finish")
+                run_lock_wait_start = time.time()
+            time.sleep(1)
+
+
+def release_run_lock():
+    global run_lock_handle
+
+    if run_lock_handle is None:
+        return
+    try:
+        if os.name == "nt":
+            run_lock_handle.seek(0)
+            msvcrt.locking(run_lock_handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(run_lock_handle.fileno(), fcntl.LOCK_UN)
+    finally:
+        run_lock_handle.close()
+        run_lock_handle = None
+
+
+def load_state_file(path, description):
+    """Return the JSON object kept in one of the monitor's state files, or {} if there is none."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Ignoring unreadable {description} {path}: {e}")
+        return {}
+
+
+def save_state_file(path, data, description):
+    """Replace a state file with data, so readers never see it half written."""
+    temp_file = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(temp_file, path)
+    except Exception as e:
+        print(f"Failed to save {description} {path}: {e}")
+
+
+def load_recent_results(since=None):
+    """Return {target id: result} for the cached results still young enough to be reused.
+
+    With since, only results checked at or after that time are returned.
+    """
+    if not reuse_results_for:
+        return {}
+    now = time.time()
+    return {key: result for key, result in load_state_file(result_cache_file, "result cache").items()
+            if 0 <= now - result.get("checked", 0) < reuse_results_for and result.get("checked", 0) >= (since or 0)}
+
+
+def save_recent_results(results):
+    """Add this run's results to the result cache, dropping any too old to be reused.
+
+    Only results that were written to the sheet belong here, so a run that reuses them
+    has nothing left to write or report.
+    """
+    if not reuse_results_for or not results:
+        return
+    recent = load_recent_results()
+    recent.update(results)
+    save_state_file(result_cache_file, recent, "result cache")
+
+
 def load_records_from_cache():
     """Load records from cache or fetch from Google Sheets if the cache is expired."""
-    global cached_records, last_cache_time
+    global cached_records, last_cache_time, records_modified_time
 
     current_time = time.time()
 
-    # If cache is empty or expired, fetch fresh data from Google Sheets
+    # If cache is empty or expired, check whether the sheet changed before fetching fresh data
     if cached_records is None or (last_cache_time is None) or (current_time - last_cache_time > CACHE_DURATION):
+        modified_time = get_sheet_modified_time()
+
+        if cached_records is not None and modified_time and modified_time == records_modified_time:
+            last_cache_time = current_time  # Nobody has touched the sheet since our copy was taken
+            return cached_records
+
+        if cached_records is None:
+            records = load_records_snapshot(modified_time)
+            if records is not None:
+                print(f"Loaded {len(records)} records from the local sheet snapshot.")
+                cached_records = records
+                last_cache_time = current_time
+                records_modified_time = modified_time
+                return cached_records
+
         print("Fetching fresh records from Google Sheets...")
         try:
-            cached_records = ws.get_all_records()  # Fetch fresh data
+            with tracing.span("sheets.get_all_records", "sheets") as span_args:
+                cached_records = ws.get_all_records()  # Fetch fresh data
+                span_args["rows"] = len(cached_records)
             last_cache_time = current_time
+            records_modified_time = modified_time
         except Exception as e:
             print(f"Failed to fetch records from Google Sheets: {e}")
             cached_records = None
@@ -140,22 +468,27 @@ def update_device_status(device_name, resource_name, resource_type, status, valu
             {'range': f'G{row_to_update}', 'values': [[current_time]]},  # Update "Last Checked"
         ]
 
-        # Update "Previous Status" and handle the status changes for "Offline Since" and "Online Since"
-        previous_status = ws.cell(row_to_update, 5).value  # Column 5 is 'Status'
+        # Update "Previous Status" and handle the status changes for "Offline Since" and "Online Since".
+        # The cached row is current: it is refetched whenever the sheet's modified time changes.
+        record = records[row_to_update - 2]
+        previous_status = record["Status"]
         updates.append({'range': f'F{row_to_update}', 'values': [[previous_status]]})  # Update "Previous Status"
+        changes = {"Value": value, "Status": status, "Previous Status": previous_status, "Last Checked": current_time}
 
         if previous_status != status:
             if status == OFFLINE:
                 updates.append({'range': f'H{row_to_update}', 'values': [[current_time]]})  # Update "Offline Since"
                 updates.append({'range': f'I{row_to_update}', 'values': [[""]]})  # Clear "Online Since"
+                changes.update({"Offline Since": current_time, "Online Since": ""})
             elif status == ONLINE:
                 updates.append({'range': f'I{row_to_update}', 'values': [[current_time]]})  # Update "Online Since"
                 updates.append({'range': f'H{row_to_update}', 'values': [[""]]})  # Clear "Offline Since"
+                changes.update({"Online Since": current_time, "Offline Since": ""})
 
         try:
             ws.batch_update(updates)  # Batch all updates in one API call
             print(f"Updated row {row_to_update} for {device_name} - {resource_name}.")
-            cached_records[row_to_update - 2]["Status"] = status  # Update the cached data
+            record.update(changes)  # Keep the cached row (and the snapshot written from it) in sync
         except Exception as e:
             print(f"Failed to update row {row_to_update} for {device_name}: {e}")
     else:
@@ -192,6 +525,115 @@ def update_device_status(device_name, resource_name, resource_type, status, valu
             print(f"Failed to append new row for {device_name} - {resource_name}: {e}")
 
 
+def get_history_worksheet():
+    """Return the History worksheet, creating it with headers the first time."""
+    global history_ws
+
+    if history_ws is None and spreadsheet is not None:
+        try:
+            try:
+                history_ws = spreadsheet.worksheet(history_sheet_name)
+            except gspread.WorksheetNotFound:
+                history_ws = spreadsheet.add_worksheet(title=history_sheet_name, rows="1000",
+                                                       cols=str(len(HISTORY_HEADERS)))
+                history_ws.append_row(HISTORY_HEADERS)
+                print(f"Worksheet '{history_sheet_name}' created.")
+        except Exception as e:
+            print(f"Failed to open the '{history_sheet_name}' worksheet: {e}")
+            history_ws = None
+    return history_ws
+
+
+def flush_history():
+    """Write the run's check results to the history files and the History worksheet."""
+    if not pending_history:
+        return
+    checks = list(pending_history)
+    pending_history.clear()
+
+    if history_dir:
+        try:
+            with tracing.span("history.append_checks", "history", checks=len(checks)):
+                history.append_checks(
+                    history_dir,
+                    [(timestamp, target_id(device_name, resource_type, resource_name), status, response_time)
+                     for timestamp, device_name, resource_name, resource_type, status, response_time in checks],
+                    history_max_file_bytes)
+        except Exception as e:
+            print(f"Failed to write check history to {history_dir}: {e}")
+
+    if history_sheet_name and get_history_worksheet() is not None:
+        rows = [[datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %I:%M:%S %p'), device_name, resource_name,
+                 resource_type, status, round(response_time, 2) if response_time is not None else ""]
+                for timestamp, device_name, resource_name, resource_type, status, response_time in checks]
+        try:
+            with tracing.span("sheets.append_rows", "sheets", rows=len(rows)):
+                history_ws.append_rows(rows)  # One API call for the whole run
+        except Exception as e:
+            print(f"Failed to append {len(rows)} rows to the '{history_sheet_name}' worksheet: {e}")
+
+
+def get_record(device_name, resource_name, resource_type):
+    """Return the cached sheet row of a device/resource, or None."""
+    records = load_records_from_cache()
+    for record in records or []:
+        if (record["Device Name"] == device_name and
+            record["Resource"] == resource_name and
+            record["Type"] == resource_type):
+            return record
+    return None
+
+
+def parse_sheet_time(value):
+    """Parse a timestamp written by update_device_status, returning epoch seconds or None."""
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d %I:%M:%S %p').timestamp()
+    except ValueError:
+        return None
+
+
+def get_backoff(device_name, resource_type, resource_name, now):
+    """Return None to check a target as usual, "skip" to leave it Offline, or "recover" for a recovery probe.
+
+    Once a resource has been Offline for backoff_after seconds, it is only fully checked again
+    after as long as it had been down at its last check (so the gap doubles each time) capped at
+    backoff_max_interval. In between, it gets a cheap recovery probe every
+    backoff_recovery_interval so one that comes back isn't reported Offline for hours.
+    Everything resets once the resource is Online again.
+    """
+    if not backoff_after or resource_type == "Heartbeat":
+        return None
+    record = get_record(device_name, resource_name, resource_type)
+    if record is None or record.get("Status") != OFFLINE:
+        return None
+    offline_since = parse_sheet_time(record.get("Offline Since"))
+    last_checked = parse_sheet_time(record.get("Last Checked"))
+    if offline_since is None or last_checked is None or last_checked - offline_since < backoff_after:
+        return None
+
+    interval = min(last_checked - offline_since, backoff_max_interval)
+    if now - last_checked >= interval:
+        return None
+    key = target_id(device_name, resource_type, resource_name)
+    if backoff_recovery_interval and now - max(last_checked, recovery_probes.get(key, 0)) >= backoff_recovery_interval:
+        recovery_probes[key] = now
+        return "recover"
+    minutes = (last_checked + interval - now) / 60
+    print(f"    {device_name} ({resource_name}) - {OFFLINE}, backed off, next check in {minutes:.0f} min")
+    return "skip"
+
+
+def get_reusable_result(device_name, resource_type, resource_info, recent_results, now):
+    """Return the result another run got for this target that this run may reuse, or None."""
+    result = recent_results.get(target_id(device_name, resource_type, resource_info['name']))
+    if (result is None or result.get("value") != resource_info['value']
+            or result.get("status") == UNREACHABLE):  # Depends on this run's parent results instead
+        return None
+    print(f"    {device_name} ({resource_info['name']}) - {result['status']}, "
+          f"reusing the result from {now - result['checked']:.0f}s ago")
+    return result
+
+
 def get_previous_status(device_name, resource_name, resource_type):
     global cached_records
 
@@ -210,13 +652,176 @@ def get_previous_status(device_name, resource_name, resource_type):
     return None
 
 
-def ping_device(ip_info, device_name):
+def target_id(device_name, resource_type, resource_name):
+    """Return the identifier used for a resource in the monitor's state."""
+    return f"{device_name}/{resource_type}/{resource_name}"
+
+
+def new_target_state(key, device_name, resource_name, resource_type, since):
+    return {
+        "id": key,
+        "device": device_name,
+        "resource": resource_name,
+        "type": resource_type,
+        "status": None,
+        "since": since,
+        "latencies": deque(maxlen=LATENCY_HISTORY_SIZE),
+    }
+
+
+def record_result(device_name, resource_name, resource_type, value, status, previous_status, response_time):
+    """Record a check result in the in-memory state served by the status server."""
+    global state_version
+
+    now = time.time()
+    key = target_id(device_name, resource_type, resource_name)
+    with state_lock:
+        state = target_states.get(key)
+        if state is None:
+            state = target_states[key] = new_target_state(key, device_name, resource_name, resource_type, now)
+        if state["status"] is not None and state["status"] != status:
+            state["since"] = now
+        state.update({"value": value, "status": status, "last_checked": now, "response_time": response_time,
+                      "details": probe_details.pop(key, None)})
+        if response_time is not None:
+            state["latencies"].append(response_time)
+
+        if previous_status is not None and previous_status != status:
+            recent_transitions.append({
+                "time": now,
+                "id": key,
+                "device": device_name,
+                "resource": resource_name,
+                "type": resource_type,
+                "from": previous_status,
+                "to": status,
+            })
+        state_version += 1
+
+
+def record_kept_status(device_name, resource_name, resource_type, value, status, checked=None, response_time=None):
+    """Show a target that wasn't probed this run (backed off, or another run's result) in the in-memory state.
+
+    Its times come from the sheet unless checked is given. A target already shown with the same
+    status is left alone, so kept targets don't change the state version every run.
+    """
+    global state_version
+
+    key = target_id(device_name, resource_type, resource_name)
+    with state_lock:
+        state = target_states.get(key)
+        if state is not None and state["status"] == status:
+            return
+
+    record = get_record(device_name, resource_name, resource_type) or {}
+    if checked is None:
+        checked = parse_sheet_time(record.get("Last Checked"))
+    since = parse_sheet_time(record.get("Offline Since" if status == OFFLINE else "Online Since")) or checked
+    with state_lock:
+        state = target_states.get(key)
+        if state is None:
+            state = target_states[key] = new_target_state(key, device_name, resource_name, resource_type, since)
+        elif state["status"] is not None:
+            state["since"] = checked or time.time()  # Changed in another run since we last saw it
+        state.update({"value": value, "status": status, "last_checked": checked, "response_time": response_time,
+                      "details": None})
+        if response_time is not None:
+            state["latencies"].append(response_time)
+        state_version += 1
+
+
+def latency_stats(latencies):
+    """Summarize a sequence of response times in milliseconds."""
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "min": ordered[0],
+        "avg": sum(ordered) / len(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+def get_status_snapshot():
+    """Return (version, status) where status is a JSON-ready copy of the in-memory state."""
+    with state_lock:
+        targets = []
+        for state in target_states.values():
+            target = {key: value for key, value in state.items() if key != "latencies"}
+            target["latency"] = latency_stats(state["latencies"])
+            targets.append(target)
+        return state_version, {
+            "generated": time.time(),
+            "targets": targets,
+            "transitions": list(recent_transitions),
+        }
+
+
+def read_neighbor_table():
+    """Return {ip: NUD state bits} from the kernel's neighbor table via netlink, {} if unavailable."""
+    if not hasattr(socket, "AF_NETLINK"):
+        return {}
+
+    neighbors = {}
+    try:
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.settimeout(1)
+            request = NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+            sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), RTM_GETNEIGH,
+                                        NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + request)
+            while True:
+                data = sock.recv(65536)
+                offset = 0
+                while offset + NLMSG_HEADER.size <= len(data):
+                    length, message_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                    if message_type == NLMSG_DONE:
+                        return neighbors
+                    if message_type == NLMSG_ERROR:
+                        raise OSError("netlink returned an error for the neighbor dump")
+                    if message_type == RTM_NEWNEIGH:
+                        family, _, state, _, _ = NDMSG.unpack_from(data, offset + NLMSG_HEADER.size)
+                        attribute = offset + NLMSG_HEADER.size + NDMSG.size
+                        while attribute + RTATTR.size <= offset + length:
+                            attribute_length, attribute_type = RTATTR.unpack_from(data, attribute)
+                            if attribute_length < RTATTR.size:
+                                break
+                            if attribute_type == NDA_DST:
+                                address = socket.inet_ntop(family, data[attribute + RTATTR.size:attribute + attribute_length])
+                                neighbors[address] = neighbors.get(address, 0) | state  # Same IP on several interfaces
+                            attribute += (attribute_length + 3) & ~3
+                    if length < NLMSG_HEADER.size:
+                        break
+                    offset += (length + 3) & ~3
+    except OSError as e:
+        print(f"Failed to read the kernel neighbor table, pinging every IP instead: {e}")
+        return {}
+
+
+def check_neighbor_table(ip_info, device_name):
+    """Return Online if the kernel recently confirmed the IP is reachable, otherwise None (so it gets pinged)."""
+    if neighbor_states.get(ip_info['value'], 0) & NUD_REACHABLE:
+        print(f"    {device_name} ({ip_info['name']}) - {ONLINE} (REACHABLE in neighbor table)")
+        return ONLINE, None
+    return None
+
+
+def ping_device(ip_info, device_name, timeout=None):
     """Ping a device and return its status and response time."""
     ip = ip_info['value']
     print(f"Starting ping check for {device_name} ({ip_info['name']}) - {ip}")
     try:
         start_time = time.time()
-        command = ["ping", "-n", "1", ip] if platform.system().lower() == "windows" else ["ping", "-c", "1", ip]
+        system = platform.system().lower()
+        command = ["ping", "-n", "1", ip] if system == "windows" else ["ping", "-c", "1", ip]
+        if timeout:
+            if system == "windows":
+                command[1:1] = ["-w", str(int(timeout * 1000))]  # Milliseconds
+            elif system == "darwin":
+                command[1:1] = ["-t", str(max(1, int(timeout)))]
+            else:
+                command[1:1] = ["-W", str(max(1, int(timeout)))]
         ping = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         end_time = (time.time() - start_time) * 1000  # Convert to milliseconds
         if ping.returncode == 0:
@@ -230,7 +835,7 @@ def ping_device(ip_info, device_name):
         return OFFLINE, None
 
 
-def check_port(ip_info, device_name):
+def check_port(ip_info, device_name, timeout=None):
     """Check specified ports and return status."""
     ip = ip_info['value']
     if 'ports' not in ip_info:
@@ -241,7 +846,7 @@ def check_port(ip_info, device_name):
         print(f"Starting port check for {device_name} ({ip_info['name']}) - {ip}:{port}")
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(3)  # 3 seconds timeout
+            sock.settimeout(timeout or 3)  # 3 seconds timeout by default
             start_time = time.time()
             result = sock.connect_ex((ip, port))
             end_time = (time.time() - start_time) * 1000  # Convert to milliseconds
@@ -262,17 +867,30 @@ def check_port(ip_info, device_name):
     return OFFLINE, None
 
 
-def check_http(url_info, device_name):
+def check_http(url_info, device_name, timeout=None):
     """Check HTTP response and return its status and response time."""
+    timeout = timeout or HTTP_TIMEOUT
+    if url_info.get('timing'):
+        return check_http_timed(url_info, device_name, timeout)
+
     url = url_info['value']
+    expect = url_info.get('expect')
     print(f"Starting HTTP check for {device_name} ({url_info['name']}) - {url}")
     try:
         start_time = time.time()
-        response = requests.get(url, timeout=5)
+        failure = None
+        # Content assertions stream the body so only as much of it as needed is downloaded
+        with requests.get(url, timeout=timeout, stream=bool(expect)) as response:
+            if response.status_code == 200 and expect:
+                failure = check_content(response.iter_content(CONTENT_CHUNK_SIZE), expect,
+                                        response.headers.get("Content-Length"))
         end_time = (time.time() - start_time) * 1000  # Convert to milliseconds
-        if response.status_code == 200:
+        if response.status_code == 200 and failure is None:
             print(f"    {device_name} ({url_info['name']}) - {ONLINE} ({end_time:.2f}ms)")
             return ONLINE, end_time
+        elif failure:
+            print(f"    {device_name} ({url_info['name']}) - {OFFLINE} - {failure}")
+            return OFFLINE, None
         else:
             print(f"    {device_name} ({url_info['name']}) - {OFFLINE}")
             return OFFLINE, None
@@ -281,6 +899,172 @@ def check_http(url_info, device_name):
         return OFFLINE, None
 
 
+def check_http_timed(url_info, device_name, timeout=HTTP_TIMEOUT):
+    """Check a URL over one connection, timing each phase and reading the TLS certificate.
+
+    The DNS, connect, TLS handshake and time-to-first-byte durations (in ms) are stored in
+    probe_details along with the negotiated TLS version/ALPN protocol and certificate expiry.
+    Redirects are not followed, so point timed checks at the final URL.
+    """
+    url = url_info['value']
+    print(f"Starting timed HTTP check for {device_name} ({url_info['name']}) - {url}")
+    parts = urlsplit(url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    details = {}
+    probe_details[target_id(device_name, "URL", url_info['name'])] = details
+
+    sock = None
+    try:
+        start_time = time.perf_counter()
+        phase_start = start_time
+
+        def end_phase(name):
+            nonlocal phase_start
+            now = time.perf_counter()
+            details[name] = (now - phase_start) * 1000  # Convert to milliseconds
+            phase_start = now
+
+        family, socktype, proto, _, address = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)[0]
+        end_phase("dns")
+
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        end_phase("connect")
+
+        if https:
+            context = ssl.create_default_context(cafile=certifi.where())
+            context.set_alpn_protocols(["http/1.1"])
+            sock = context.wrap_socket(sock, server_hostname=parts.hostname)
+            end_phase("tls")
+            check_certificate(sock, url_info, device_name, details)
+
+        connection = http.client.HTTPConnection(parts.hostname, port, timeout=timeout)
+        connection.sock = sock  # Reuse the connection timed above instead of opening another
+        connection.request("GET", path, headers={"Host": parts.netloc.rpartition("@")[2]})
+        response = connection.getresponse()
+        end_phase("ttfb")
+        failure = None
+        if response.status == 200 and url_info.get('expect'):
+            failure = check_content(iter(lambda: response.read(CONTENT_CHUNK_SIZE), b""), url_info['expect'],
+                                    response.getheader("Content-Length"))
+        else:
+            response.read()
+        end_time = (time.perf_counter() - start_time) * 1000  # Convert to milliseconds
+        details["total"] = end_time
+        details["status_code"] = response.status
+
+        phases = ", ".join(f"{name} {details[name]:.2f}ms" for name in ("dns", "connect", "tls", "ttfb") if name in details)
+        if response.status == 200 and failure is None:
+            print(f"    {device_name} ({url_info['name']}) - {ONLINE} ({end_time:.2f}ms: {phases})")
+            return ONLINE, end_time
+        elif failure:
+            details["content_failure"] = failure
+            print(f"    {device_name} ({url_info['name']}) - {OFFLINE} - {failure}")
+            return OFFLINE, None
+        else:
+            print(f"    {device_name} ({url_info['name']}) - {OFFLINE} (HTTP {response.status})")
+            return OFFLINE, None
+    except Exception as e:
+        details["error"] = str(e)
+        print(f"    {device_name} ({url_info['name']}) - {OFFLINE} - Error: {e}")
+        return OFFLINE, None
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def check_content(chunks, expect, content_length=None):
+    """Evaluate a URL's content assertions against its body as it streams in.
+
+    expect can hold 'contains' (substring), 'regex', 'json_path' (dotted, list items by
+    index) with an optional 'json_equals', and 'max_bytes'. Reading stops as soon as every
+    substring/regex assertion has passed, and never goes past max_bytes; JSON assertions
+    need the whole body within that limit. Returns None if the body passes, otherwise a
+    description of the failure.
+
+    A regex match only passes early if it ends at least REGEX_OVERLAP bytes before the data
+    read so far, since anchors, lookaheads and greedy tails can turn out differently once
+    more arrives; only a lookahead reaching further than that past the match could still be
+    misjudged. Each chunk is searched along with the last REGEX_OVERLAP bytes before it, and
+    anything undecided is settled by one search of the whole body at the end.
+    """
+    max_bytes = expect.get('max_bytes', DEFAULT_MAX_BODY_BYTES)
+    needle = expect['contains'].encode("utf-8") if expect.get('contains') else None
+    pattern = re.compile(expect['regex'].encode("utf-8")) if expect.get('regex') else None
+    json_path = expect.get('json_path')
+    whole_body = json_path is not None or not (needle or pattern)  # Can't be decided before the end
+
+    if whole_body and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        return f"body is {content_length} bytes, over the {max_bytes} byte limit"
+
+    body = bytearray()
+    tail = b""  # End of what was read so far, so a substring split across chunks is still found
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            chunk = chunk[:len(chunk) - (size - max_bytes)]
+        if needle:
+            window = tail + chunk
+            if needle in window:
+                needle = None
+            else:
+                tail = window[max(0, len(window) - len(needle) + 1):]
+        if pattern or json_path is not None:
+            search_from = max(0, len(body) - REGEX_OVERLAP)
+            body += chunk
+            if pattern:
+                match = pattern.search(body, search_from)
+                if match and match.end() <= len(body) - REGEX_OVERLAP:
+                    pattern = None
+        if not whole_body and needle is None and pattern is None:
+            return None
+        if size > max_bytes:
+            break
+
+    if needle:
+        return f"'{expect['contains']}' not found in the first {min(size, max_bytes)} bytes"
+    if pattern and pattern.search(body):
+        pattern = None
+    if pattern:
+        return f"/{expect['regex']}/ not matched in the first {min(size, max_bytes)} bytes"
+    if size > max_bytes:
+        return f"body is over the {max_bytes} byte limit"
+
+    if json_path is not None:
+        try:
+            value = json.loads(bytes(body))
+            for key in json_path.removeprefix("$.").split(".") if json_path.strip("$.") else []:
+                value = value[int(key)] if isinstance(value, list) else value[key]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            return f"JSON path '{json_path}' not found ({e!r})"
+        if 'json_equals' in expect and value != expect['json_equals']:
+            return f"JSON path '{json_path}' is {value!r}, expected {expect['json_equals']!r}"
+    return None
+
+
+def check_certificate(tls_sock, url_info, device_name, details):
+    """Record the negotiated protocol and certificate expiry of a TLS socket, warning if it expires soon."""
+    details["tls_version"] = tls_sock.version()
+    details["alpn_protocol"] = tls_sock.selected_alpn_protocol()
+    cert = tls_sock.getpeercert()
+    if not cert or "notAfter" not in cert:
+        return
+
+    expires = ssl.cert_time_to_seconds(cert["notAfter"])
+    days_left = (expires - time.time()) / 86400
+    details["cert_expires"] = expires
+    details["cert_days_left"] = days_left
+
+    warning_days = url_info.get('cert_warning_days', cert_expiry_warning_days)
+    if warning_days is not None and days_left <= warning_days:
+        print(f"    WARNING: {device_name} ({url_info['name']}) certificate expires in {days_left:.1f} days")
+        certificate_warnings.append((device_name, url_info['name'], url_info['value'], days_left))
+
+
 def check_directory(directory_info, device_name):
     """Check if directory exists and return its status."""
     directory = directory_info['value']
@@ -297,9 +1081,50 @@ def check_directory(directory_info, device_name):
         return OFFLINE, None
 
 
+def check_heartbeat(heartbeat_info, device_name):
+    """Report whether an agent's heartbeat arrived within its window.
+
+    Returns (None, None) when there is nothing to report yet: no listener is running, or
+    the target hasn't had a full window to check in since the monitor started.
+    """
+    heartbeat_id = heartbeat_info['value']
+    print(f"Starting heartbeat check for {device_name} ({heartbeat_info['name']}) - {heartbeat_id}")
+    if not heartbeat.listening:
+        print(f"    {device_name} ({heartbeat_info['name']}) - skipped, no heartbeat listener is running")
+        return None, None
+
+    alive = heartbeat.get_status(heartbeat_id)
+    if alive is None:
+        print(f"    {device_name} ({heartbeat_info['name']}) - waiting for first heartbeat")
+        return None, None
+
+    last_beat = heartbeat.get_last_beat(heartbeat_id)
+    age = f" (last beat {time.time() - last_beat[1]:.0f}s ago from {last_beat[2]})" if last_beat else ""
+    status = ONLINE if alive else OFFLINE
+    print(f"    {device_name} ({heartbeat_info['name']}) - {status}{age}")
+    return status, None
+
+
+def sync_heartbeat_targets():
+    """Register the configured heartbeat targets with the heartbeat receiver."""
+    heartbeat.sync_targets({
+        heartbeat_info['value']: (heartbeat_info.get('window', HEARTBEAT_WINDOW),
+                                  heartbeat_info.get('secret', heartbeat_secret))
+        for resources in devices.values() for heartbeat_info in resources.get("heartbeats") or []
+    })
+
+
 def send_summary_email(offline_devices, online_devices):
-    """Send a single email with a summary of offline and online devices, including response times."""
-    if not offline_devices and not online_devices:
+    """Send a single email with a summary of offline and online devices, including response times.
+
+    Expiring certificates are emailed about on their own too, at most once per
+    CERTIFICATE_WARNING_INTERVAL per certificate.
+    """
+    now = time.time()
+    warned = load_state_file(certificate_warnings_file, "certificate warnings")
+    due_warnings = [warning for warning in certificate_warnings
+                    if now - warned.get(target_id(warning[0], "URL", warning[1]), 0) >= CERTIFICATE_WARNING_INTERVAL]
+    if not offline_devices and not online_devices and not due_warnings:
         print("No changes in status since last run... all done.")
         return
 
@@ -314,6 +1139,9 @@ def send_summary_email(offline_devices, online_devices):
     if online_count > 0:
         online_label = "Device" if online_count == 1 else "Devices"
         subject_parts.append(f"{online_count} New Online {online_label}")
+    if due_warnings:
+        certificate_label = "Certificate" if len(due_warnings) == 1 else "Certificates"
+        subject_parts.append(f"{len(due_warnings)} {certificate_label} Expiring Soon")
 
     subject = "Devices"
     if subject_parts:
@@ -328,6 +1156,13 @@ def send_summary_email(offline_devices, online_devices):
                 append = ""
             body += f"{device} - {resource} ({value}){append}\n"
 
+    if unreachable_resources:
+        body += "\nNot checked because a device they depend on is offline:\n"
+        for root_device, resources in unreachable_resources.items():
+            label = "resource" if len(resources) == 1 else "resources"
+            names = ", ".join(f"{device} - {resource}" for device, resource, _ in resources)
+            body += f"{root_device} - {len(resources)} {label} unreachable ({names})\n"
+
     if online_devices:
         body += "\nDevices that came back online:\n"
         for device, resource, value, response_time in online_devices:
@@ -337,14 +1172,23 @@ def send_summary_email(offline_devices, online_devices):
                 append = ""
             body += f"{device} - {resource} ({value}){append}\n"
 
+    if due_warnings:
+        body += "\nCertificates expiring soon:\n"
+        for device, resource, value, days_left in due_warnings:
+            body += f"{device} - {resource} ({value}) - {days_left:.1f} days left\n"
+
     google_sheet_link = f"https://docs.google.com/spreadsheets/d/{google_sheet_id}/edit#gid=0"
     body += f"\n\n\nGoogle Sheet: {google_sheet_link}"
 
-    send_email(subject, body)
+    if send_email(subject, body) and due_warnings:
+        warned = {key: warned_at for key, warned_at in warned.items()
+                  if now - warned_at < CERTIFICATE_WARNING_INTERVAL}
+        warned.update((target_id(device, "URL", resource), now) for device, resource, _, _ in due_warnings)
+        save_state_file(certificate_warnings_file, warned, "certificate warnings")
 
 
 def send_email(subject, body):
-    """Send an email to notify the recipient of status changes."""
+    """Send an email to notify the recipient of status changes; returns True if it was sent."""
     print(f"Sending email to {', '.join(receiver_emails)}")
     print(f"Subject: {subject}")
     print(f"Body:\n{body}")
@@ -355,95 +1199,531 @@ def send_email(subject, body):
     message.attach(MIMEText(body, "plain"))
 
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, email_password)
-        server.sendmail(sender_email, receiver_emails, message.as_string())
-        server.quit()
+        with tracing.span("send_email", "email", subject=subject, recipients=len(receiver_emails)):
+            server = smtplib.SMTP(smtp_server, smtp_port)
+            server.starttls()
+            server.login(sender_email, email_password)
+            server.sendmail(sender_email, receiver_emails, message.as_string())
+            server.quit()
         print(f"Email sent to {', '.join(receiver_emails)}")
+        return True
     except Exception as e:
         print(f"Failed to send email: {e}")
+        return False
+
+
+def get_parent(device_name):
+    """Return the name of the device this one depends on, or None."""
+    parent = devices[device_name].get('parent')
+    return parent if parent in devices else None
+
+
+def ordered_device_names():
+    """Return the device names ordered so every parent comes before its children."""
+    ordered = []
+    placed = set()
+    for device_name in devices:
+        if devices[device_name].get('parent') not in (None, *devices):
+            print(f"Ignoring unknown parent '{devices[device_name]['parent']}' of {device_name}.")
+        chain = []
+        name = device_name
+        while name is not None and name not in placed and name not in chain:
+            chain.append(name)
+            name = get_parent(name)
+        if name in chain:
+            print(f"Dependency loop involving {name}, its children may be probed before it.")
+        for name in reversed(chain):
+            ordered.append(name)
+            placed.add(name)
+    return ordered
+
+
+def find_down_parent(device_name, device_statuses):
+    """Return the root-cause device if this device's parent is down, else None.
+
+    A parent is down when it has results this run and none of them is Online. If the
+    parent is itself behind a down device, the top-most down ancestor is returned.
+    """
+    root = None
+    seen = {device_name}
+    parent = get_parent(device_name)
+    while parent is not None and parent not in seen:
+        statuses = device_statuses.get(parent)
+        if not statuses or ONLINE in statuses:
+            break
+        root = parent
+        seen.add(parent)
+        parent = get_parent(parent)
+    return root
 
 
-def check_devices():
-    """Check the status of all devices and collect any that changed status."""
-    offline_devices = []
-    online_devices = []
+def iter_targets():
+    """Yield (device_name, resource_type, resource_info) for every configured resource, parents first."""
+    for device_name in ordered_device_names():
+        resources = devices[device_name]
+        for key, resource_type in RESOURCE_TYPES:
+            for resource_info in resources.get(key) or []:
+                yield device_name, resource_type, resource_info
 
-    for device_name, resources in devices.items():
-        # Check URLs
-        if "urls" in resources:
-            for url_info in resources["urls"]:
-                current_status, response_time = check_http(url_info, device_name)
-                previous_status = get_previous_status(device_name, url_info['name'], "URL")
-
-                # Update device status before handling status changes
-                update_device_status(device_name, url_info['name'], "URL", current_status, url_info['value'])
-
-                # Handle the case when it's the first run (no previous status)
-                if previous_status is None:
-                    if current_status == OFFLINE:
-                        offline_devices.append((device_name, url_info['name'], url_info['value'], response_time))
-                    elif current_status == ONLINE:
-                        online_devices.append((device_name, url_info['name'], url_info['value'], response_time))
-                    continue
 
-                # Handle status transitions
-                if previous_status == ONLINE and current_status == OFFLINE:
-                    offline_devices.append((device_name, url_info['name'], url_info['value'], response_time))
-                elif previous_status == OFFLINE and current_status == ONLINE:
-                    online_devices.append((device_name, url_info['name'], url_info['value'], response_time))
-
-        # Check IPs
-        if "ips" in resources:
-            for ip_info in resources["ips"]:
-                if ip_info.get('ports'):
-                    current_status, response_time = check_port(ip_info, device_name)
-                else:
-                    current_status, response_time = ping_device(ip_info, device_name)
-                previous_status = get_previous_status(device_name, ip_info['name'], "IP")
-
-                # Update device status before handling status changes
-                update_device_status(device_name, ip_info['name'], "IP", current_status, ip_info['value'])
-
-                # Handle the case when it's the first run (no previous status)
-                if previous_status is None:
-                    if current_status == OFFLINE:
-                        offline_devices.append((device_name, ip_info['name'], ip_info['value'], response_time))
-                    elif current_status == ONLINE:
-                        online_devices.append((device_name, ip_info['name'], ip_info['value'], response_time))
-                    continue
+def config_changed():
+    """Return True if local_config.py has been modified since it was last loaded."""
+    try:
+        return os.stat(local_config.__file__).st_mtime_ns != config_mtime
+    except OSError:
+        return False
+
+
+def configured_targets():
+    """Return {target id: (parent, resource type, resource info)} for the current config."""
+    return {
+        target_id(device_name, resource_type, resource_info['name']):
+            (devices[device_name].get('parent'), resource_type, dict(resource_info))
+        for device_name, resource_type, resource_info in iter_targets()
+    }
+
+
+def forget_targets(keys):
+    """Drop the in-memory state of targets that are no longer configured."""
+    global state_version
 
-                # Handle status transitions
-                if previous_status == ONLINE and current_status == OFFLINE:
-                    offline_devices.append((device_name, ip_info['name'], ip_info['value'], response_time))
-                elif previous_status == OFFLINE and current_status == ONLINE:
-                    online_devices.append((device_name, ip_info['name'], ip_info['value'], response_time))
-
-        # Check directories
-        if "directories" in resources:
-            for directory_info in resources["directories"]:
-                current_status, response_time = check_directory(directory_info, device_name)
-                previous_status = get_previous_status(device_name, directory_info['name'], "Directory")
-
-                # Update device status before handling status changes
-                update_device_status(device_name, directory_info['name'], "Directory", current_status, directory_info['value'])
-
-                # Handle the case when it's the first run (no previous status)
-                if previous_status is None:
-                    if current_status == OFFLINE:
-                        offline_devices.append((device_name, directory_info['name'], directory_info['value'], response_time))
-                    elif current_status == ONLINE:
-                        online_devices.append((device_name, directory_info['name'], directory_info['value'], response_time))
+    with state_lock:
+        for key in keys:
+            target_states.pop(key, None)
+            probe_details.pop(key, None)
+        state_version += 1
+
+
+def reload_config():
+    """Reload local_config and apply the differences without losing any state.
+
+    Results, latency history, the cached sheet and the Google Sheets connection are kept;
+    only removed targets are forgotten, and Google Sheets is only reconnected if its settings
+    changed. Returns the ids of added or changed targets (to be checked right away), or
+    None if the new config couldn't be loaded.
+    """
+    global config_mtime, spreadsheet, ws, history_ws, cached_records, last_cache_time, records_modified_time
+
+    config_mtime = os.stat(local_config.__file__).st_mtime_ns
+    old_targets = configured_targets()
+    old_sheet = (google_credentials, google_sheet_id, google_sheet_name)
+    old_history_sheet = history_sheet_name
+    old_limits = (max_probes_per_host, max_probes_per_subnet, subnet_prefix_v4)
+    namespace = vars(local_config)
+    old_config = dict(namespace)
+
+    try:
+        # reload() runs the file in the module's existing namespace; empty it first so settings
+        # that were removed or commented out go back to their defaults
+        for name in [name for name in namespace if not name.startswith("__")]:
+            del namespace[name]
+        importlib.reload(local_config)
+        load_config()
+    except Exception as e:
+        print(f"Failed to reload local_config, keeping the previous settings: {e}")
+        namespace.clear()
+        namespace.update(old_config)
+        load_config()
+        return None
+
+    new_targets = configured_targets()
+    added = new_targets.keys() - old_targets.keys()
+    removed = old_targets.keys() - new_targets.keys()
+    changed = {key for key in new_targets.keys() & old_targets.keys() if new_targets[key] != old_targets[key]}
+    forget_targets(removed)
+    sync_heartbeat_targets()
+
+    if (max_probes_per_host, max_probes_per_subnet, subnet_prefix_v4) != old_limits:
+        with limits_lock:
+            host_semaphores.clear()
+            subnet_semaphores.clear()
+
+    if (google_credentials, google_sheet_id, google_sheet_name) != old_sheet:
+        print("Google Sheet settings changed, reconnecting.")
+        spreadsheet = ws = history_ws = None
+        cached_records = last_cache_time = records_modified_time = None
+        initialize_log()
+    elif history_sheet_name != old_history_sheet:
+        history_ws = None
+
+    print(f"Reloaded local_config: {len(added)} added, {len(changed)} changed, {len(removed)} removed targets.")
+    return added | changed
+
+
+def url_accepts_connections(url_info, timeout):
+    """Return True if a TCP connection to the URL's host and port opens within timeout."""
+    parts = urlsplit(url_info['value'])
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        with socket.create_connection((parts.hostname, port), timeout=timeout):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
+def probe_target(device_name, resource_type, resource_info, recovery=False):
+    """Run the check that matches the resource type and return its status and response time.
+
+    A status of None means the check has no result this run and the target is left as is.
+    A recovery probe of a backed-off target pings with backoff_probe_timeout, and only runs a
+    URL's full check (with its usual timeout) once a TCP connection to it gets through.
+    """
+    timeout = None
+    if recovery:
+        if resource_type == "URL" and not url_accepts_connections(resource_info, backoff_probe_timeout):
+            print(f"    {device_name} ({resource_info['name']}) - {OFFLINE}, recovery probe got no connection")
+            return OFFLINE, None
+        if resource_type == "IP":
+            timeout = backoff_probe_timeout
+    if resource_type == "URL":
+        return check_http(resource_info, device_name, timeout)
+    if resource_type == "IP":
+        if resource_info.get('ports'):
+            return check_port(resource_info, device_name, timeout)
+        return ping_device(resource_info, device_name, timeout)
+    if resource_type == "Heartbeat":
+        return check_heartbeat(resource_info, device_name)
+    return check_directory(resource_info, device_name)
+
+
+def device_depth(device_name):
+    """Return how many parents a device has above it (0 for a device without a parent)."""
+    depth = 0
+    seen = {device_name}
+    parent = get_parent(device_name)
+    while parent is not None and parent not in seen:
+        depth += 1
+        seen.add(parent)
+        parent = get_parent(parent)
+    return depth
+
+
+def iter_target_levels():
+    """Yield lists of targets grouped by dependency depth, parents' level first."""
+    levels = {}
+    for target in iter_targets():
+        levels.setdefault(device_depth(target[0]), []).append(target)
+    for depth in sorted(levels):
+        yield levels[depth]
+
+
+def target_host(resource_type, resource_info):
+    """Return the network host a target's probe talks to, or None for local checks."""
+    value = resource_info['value']
+    if resource_type == "URL":
+        return urlsplit(value).hostname
+    if resource_type == "IP":
+        return value
+    if resource_type == "Directory" and value[:2] in ("\\\\", "//"):
+        return value[2:].replace("\\", "/").split("/", 1)[0]  # UNC path, \\server\share
+    return None
+
+
+def target_subnet(host):
+    """Return the subnet an IP address belongs to for the per-subnet limit, None for host names."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    prefix = subnet_prefix_v4 if address.version == 4 else SUBNET_PREFIX_V6
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+def get_limit(semaphores, key, limit):
+    with limits_lock:
+        if key not in semaphores:
+            semaphores[key] = threading.BoundedSemaphore(limit)
+        return semaphores[key]
+
+
+def acquire_limits(resource_type, resource_info, now):
+    """Take a target's subnet and host slots without waiting for them.
+
+    Returns (limits, retry_at): the semaphores now held, or None if the target can't start
+    yet, with the time the per-host rate next allows it (None when it waits for a free slot).
+    """
+    host = target_host(resource_type, resource_info)
+    if not host:
+        return [], None
+    if probes_per_host_per_second and host_next_start.get(host, 0) > now:
+        return None, host_next_start[host]
+
+    candidates = []
+    subnet = target_subnet(host)
+    if subnet and max_probes_per_subnet:
+        candidates.append(get_limit(subnet_semaphores, subnet, max_probes_per_subnet))
+    if max_probes_per_host:
+        candidates.append(get_limit(host_semaphores, host, max_probes_per_host))
+    limits = []
+    for limit in candidates:
+        if not limit.acquire(blocking=False):
+            for held in reversed(limits):
+                held.release()
+            return None, None
+        limits.append(limit)
+    if probes_per_host_per_second:
+        host_next_start[host] = now + 1 / probes_per_host_per_second
+    return limits, None
+
+
+def probe_start_offset(key, count, spread):
+    """Return a target's start offset within its level's share of the probe spread.
+
+    Each target gets a stable slot (so its check interval stays even from run to run) plus
+    random jitter within that slot.
+    """
+    if not spread:
+        return 0
+    slot = zlib.crc32(key.encode("utf-8")) / 2 ** 32
+    return (slot + random.random() / max(count, 1)) * spread % spread
+
+
+def limited_probe(device_name, resource_type, resource_info, recovery, limits, start_at):
+    """Probe a target whose slots were taken by probe_targets, releasing them when it's done."""
+    key = target_id(device_name, resource_type, resource_info['name'])
+    try:
+        with tracing.span("probe", "probe", target=key, value=resource_info['value'],
+                          delay=time.time() - start_at) as span_args:
+            current_status, response_time = probe_target(device_name, resource_type, resource_info, recovery)
+            span_args.update({"status": current_status, "response_time": response_time})
+        return current_status, response_time
+    finally:
+        for limit in reversed(limits):
+            limit.release()
+
+
+def profiled_probe(*args):
+    """Run limited_probe on an executor thread under a profiler of its own."""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Python 3.12+, where the run's profiler already sees every thread
+        return limited_probe(*args)
+    try:
+        return limited_probe(*args)
+    finally:
+        profiler.disable()
+        probe_profilers.append(profiler)
+
+
+def probe_targets(targets, recoveries, executor, spread):
+    """Probe targets, concurrently when an executor is given, and return their results in order.
+
+    Start times are spread over spread seconds from now. This thread hands a probe to the
+    executor only once its start time has come and its host and subnet have a free slot, so a
+    busy host queues its own probes without tying up workers other targets could use.
+    """
+    level_start = time.time()
+    starts = [level_start + probe_start_offset(target_id(device_name, resource_type, resource_info['name']),
+                                               len(targets), spread)
+              for device_name, resource_type, resource_info in targets]
+    pending = sorted(range(len(targets)), key=lambda i: starts[i])
+    futures = {}
+    running = 0
+    max_running = probe_workers if executor is not None else 1
+    finished = threading.Condition()
+
+    def on_done(_):
+        nonlocal running
+        with finished:
+            running -= 1
+            finished.notify()
+
+    probe = profiled_probe if profile_probes and executor is not None else limited_probe
+    with finished:
+        while pending:
+            now = time.time()
+            wake = None
+            for index in list(pending):
+                if running >= max_running:
+                    break
+                if starts[index] > now:
+                    wake = starts[index] if wake is None else min(wake, starts[index])
+                    break  # Pending is in start order, nothing after this one is due either
+                device_name, resource_type, resource_info = targets[index]
+                limits, retry_at = acquire_limits(resource_type, resource_info, now)
+                if limits is None:
+                    if retry_at is not None:
+                        wake = retry_at if wake is None else min(wake, retry_at)
+                    continue  # Try the targets behind it; this one waits for a slot or its rate
+                pending.remove(index)
+                args = (device_name, resource_type, resource_info, recoveries[index], limits, starts[index])
+                if executor is None:
+                    futures[index] = Future()
+                    futures[index].set_result(probe(*args))
                     continue
+                running += 1
+                futures[index] = executor.submit(probe, *args)
+                futures[index].add_done_callback(on_done)
+            if pending:
+                # Woken early whenever a probe finishes and frees a worker or a slot
+                if wake is not None:
+                    finished.wait(max(0, wake - time.time()))
+                else:
+                    finished.wait(None if running else 1)
+    return [futures[index].result() for index in range(len(targets))]
+
+
+def check_devices(only=None, reuse_since=None):
+    """Check the status of all devices (or only the given target ids) and collect any that changed status.
 
-                # Handle status transitions
-                if previous_status == ONLINE and current_status == OFFLINE:
-                    offline_devices.append((device_name, directory_info['name'], directory_info['value'], response_time))
-                elif previous_status == OFFLINE and current_status == ONLINE:
-                    online_devices.append((device_name, directory_info['name'], directory_info['value'], response_time))
+    Targets are probed a dependency level at a time (concurrently, within the per-host and
+    per-subnet limits, each level spread over its share of probe_spread) and their results are
+    then written in order on this thread. With reuse_since, results other runs wrote since then
+    (and within reuse_results_for seconds) are reused rather than probed and written again.
+    """
+    offline_devices = []
+    online_devices = []
+    certificate_warnings.clear()
+    unreachable_resources.clear()
+    device_statuses = {}  # Device -> statuses of its resources this run, to tell whether a parent is down
+    sync_heartbeat_targets()
+    neighbor_states.clear()
+    if passive_presence:
+        with tracing.span("read_neighbor_table"):
+            neighbor_states.update(read_neighbor_table())
+    cycle_start = time.time()
+    # Targets asked for explicitly (e.g. after a config change) are always probed
+    recent_results = load_recent_results(reuse_since) if only is None and reuse_since is not None else {}
+    run_results = {}  # Target id -> result written this run, for the result cache
+    recovery_probes.clear()
+    if backoff_after and backoff_recovery_interval:
+        recovery_probes.update(load_state_file(recovery_probes_file, "recovery probe times"))
+
+    levels = list(iter_target_levels())
+    if only is not None:
+        levels = [[target for target in targets if target_id(target[0], target[1], target[2]['name']) in only]
+                  for targets in levels]
+    target_count = sum(len(targets) for targets in levels)
+
+    executor = ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix="probe") if probe_workers > 1 else None
+    try:
+        for targets in levels:
+            plans = [plan_target(device_name, resource_type, resource_info, device_statuses, recent_results,
+                                 only, cycle_start)
+                     for device_name, resource_type, resource_info in targets]
+            to_probe = [(target, action == "recover") for target, (action, _) in zip(targets, plans)
+                        if action in ("probe", "recover")]
+            # Each level starts once its parents are done, so it spreads over its own share from then
+            spread = probe_spread * len(targets) / target_count if target_count else 0
+            results = iter(probe_targets([target for target, _ in to_probe], [recovery for _, recovery in to_probe],
+                                         executor, spread))
+
+            for (device_name, resource_type, resource_info), (action, detail) in zip(targets, plans):
+                resource_name = resource_info['name']
+                down_parent = None
+                if action == "keep":
+                    # Known without probing and already written, so it's only shown and counts for its children
+                    status, checked, response_time = detail
+                    record_kept_status(device_name, resource_name, resource_type, resource_info['value'], status,
+                                       checked, response_time)
+                    device_statuses.setdefault(device_name, []).append(status)
+                    continue
+                elif action == "unreachable":
+                    down_parent = detail
+                    current_status, response_time = UNREACHABLE, None
+                    print(f"    {device_name} ({resource_name}) - {UNREACHABLE}, {down_parent} is down")
+                elif action == "passive":
+                    current_status, response_time = detail
+                else:
+                    current_status, response_time = next(results)
+                    if action == "recover" and current_status == OFFLINE:
+                        # Still down; only a full check is written, so the backoff schedule holds
+                        record_kept_status(device_name, resource_name, resource_type, resource_info['value'], OFFLINE)
+                        device_statuses.setdefault(device_name, []).append(OFFLINE)
+                        continue
+                if current_status is None:
+                    continue  # Nothing to report for this target this run
+                device_statuses.setdefault(device_name, []).append(current_status)
+                handle_result(device_name, resource_type, resource_info, current_status, response_time, down_parent,
+                              offline_devices, online_devices)
+                run_results[target_id(device_name, resource_type, resource_name)] = {
+                    "value": resource_info['value'], "status": current_status, "response_time": response_time,
+                    "checked": time.time()}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with tracing.span("save_records_snapshot", "sheets"):
+        save_records_snapshot()
+    flush_history()
+    save_recent_results(run_results)
+    if backoff_after and backoff_recovery_interval:
+        # Older probe times no longer hold anything back
+        save_state_file(recovery_probes_file, {key: probed for key, probed in recovery_probes.items()
+                                               if cycle_start - probed < backoff_recovery_interval},
+                        "recovery probe times")
 
     return offline_devices, online_devices
 
 
+def plan_target(device_name, resource_type, resource_info, device_statuses, recent_results, only, now):
+    """Decide how to get a target's status this run.
+
+    Returns ("unreachable", down parent) for targets behind a down device, ("keep", (status,
+    checked time or None, response time)) for ones that are left as they are (a result another
+    run just got, or backed off while Offline), ("passive", (status, response time)) for IPs the
+    kernel's neighbor table vouches for, ("recover", None) for a backed-off target's recovery
+    probe and ("probe", None) for everything else.
+    """
+    # Don't spend a full timeout on something we already know we can't reach
+    down_parent = find_down_parent(device_name, device_statuses)
+    if down_parent is not None:
+        return "unreachable", down_parent
+    result = get_reusable_result(device_name, resource_type, resource_info, recent_results, now)
+    if result is not None:
+        return "keep", (result["status"], result["checked"], result["response_time"])
+    if resource_type == "IP" and not resource_info.get('ports'):
+        # Decided without sending anything, so it needn't wait for a probe slot or rate budget
+        passive = check_neighbor_table(resource_info, device_name)
+        if passive is not None:
+            return "passive", passive
+    if only is not None:
+        return "probe", None  # Targets asked for explicitly are probed even if backed off
+    backoff = get_backoff(device_name, resource_type, resource_info['name'], now)
+    if backoff == "skip":
+        return "keep", (OFFLINE, None, None)  # Still Offline as far as we know
+    return backoff or "probe", None
+
+
+def handle_result(device_name, resource_type, resource_info, current_status, response_time, down_parent,
+                  offline_devices, online_devices):
+    """Write a check result to the sheet and state, and collect it if the status changed."""
+    resource_name = resource_info['name']
+    value = resource_info['value']
+    pending_history.append((time.time(), device_name, resource_name, resource_type, current_status, response_time))
+    previous_status = get_previous_status(device_name, resource_name, resource_type)
+    reported_status = previous_status
+    if previous_status == UNREACHABLE:
+        # Unreachable writes leave Offline/Online Since alone, so they still tell what was last reported
+        record = get_record(device_name, resource_name, resource_type) or {}
+        reported_status = OFFLINE if record.get("Offline Since") else ONLINE if record.get("Online Since") else None
+
+    # Update device status before handling status changes
+    with tracing.span("update_device_status", "sheets", target=target_id(device_name, resource_type, resource_name),
+                      status=current_status):
+        update_device_status(device_name, resource_name, resource_type, current_status, value)
+    record_result(device_name, resource_name, resource_type, value, current_status, previous_status, response_time)
+
+    # Report resources behind a down parent once, under the root cause, instead of one by one
+    if current_status == UNREACHABLE:
+        if previous_status != UNREACHABLE:
+            unreachable_resources.setdefault(down_parent, []).append((device_name, resource_name, value))
+        return
+
+    # Handle the case when it's the first run (nothing reported yet)
+    if reported_status is None:
+        if current_status == OFFLINE:
+            offline_devices.append((device_name, resource_name, value, response_time))
+        elif current_status == ONLINE:
+            online_devices.append((device_name, resource_name, value, response_time))
+        return
+
+    # Handle status transitions, measured from what was reported before any Unreachable period
+    if reported_status != OFFLINE and current_status == OFFLINE:
+        offline_devices.append((device_name, resource_name, value, response_time))
+    elif reported_status == OFFLINE and current_status == ONLINE:
+        online_devices.append((device_name, resource_name, value, response_time))
+
+
 initialize_log()
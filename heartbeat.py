@@ -0,0 +1,214 @@
+import hashlib
+import hmac
+import math
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Heartbeats are "<id>|<unix time>|<hex HMAC-SHA256 of '<id>|<unix time>'>", sent as a UDP
+# datagram or as the body of an HTTP POST to /heartbeat. A beat is accepted when the signature
+# matches the target's secret, its time is within MAX_CLOCK_SKEW of ours and newer than the
+# last accepted beat (so captured packets can't be replayed).
+MAX_CLOCK_SKEW = 60  # Seconds
+MAX_PAYLOAD_BYTES = 1024
+
+heartbeat_lock = threading.Lock()
+targets = {}  # Heartbeat id -> {"window", "secret", "registered" (monotonic time)}
+last_beats = {}  # Heartbeat id -> (beat time, received time, source address)
+listening = False  # True once a listener is running; beats can't be received otherwise
+
+
+class TimerWheel:
+    """Hashed timing wheel tracking one deadline per key.
+
+    Scheduling (or rescheduling) a key is O(1) and advancing the clock only visits the
+    slots for the ticks that passed, so cost is proportional to what expires rather than
+    to the number of keys. Superseded entries are dropped lazily when their slot comes up.
+    Times are on the time.monotonic() clock.
+    """
+
+    def __init__(self, tick=1.0, slot_count=4096, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slot_count)]
+        self.deadlines = {}
+        self.current_tick = int((time.monotonic() if now is None else now) / tick)
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        # File it under the first tick at or after the deadline, so it has passed when that slot is
+        # visited, and never under one that was already visited, or it would wait a whole turn
+        tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        self.slots[tick % len(self.slots)].append((key, deadline))
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """Move the clock to now and return the keys whose deadline has passed."""
+        expired = []
+        target_tick = int(now / self.tick)
+        ticks = min(target_tick - self.current_tick, len(self.slots))
+        for tick in range(target_tick - ticks + 1, target_tick + 1):
+            index = tick % len(self.slots)
+            remaining = []
+            for key, deadline in self.slots[index]:
+                if self.deadlines.get(key) != deadline:
+                    continue  # Rescheduled or cancelled since this entry was added
+                if deadline <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    remaining.append((key, deadline))  # Due in a later turn of the wheel
+            self.slots[index] = remaining
+        self.current_tick = max(self.current_tick, target_tick)
+        return expired
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+
+wheel = TimerWheel()
+
+
+def sign(heartbeat_id, timestamp, secret):
+    """Return the signature an agent must send for a heartbeat."""
+    message = f"{heartbeat_id}|{timestamp}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def sync_targets(configured):
+    """Replace the set of heartbeat targets with {id: (window seconds, secret)}.
+
+    Targets that are already known keep their last beat and deadline. Targets without a
+    secret can't accept any beat, so they are reported once when they are registered.
+    """
+    now = time.monotonic()
+    with heartbeat_lock:
+        for heartbeat_id in list(targets):
+            if heartbeat_id not in configured:
+                del targets[heartbeat_id]
+                last_beats.pop(heartbeat_id, None)
+                wheel.cancel(heartbeat_id)
+        for heartbeat_id, (window, secret) in configured.items():
+            target = targets.get(heartbeat_id)
+            if not secret and (target is None or target["secret"]):
+                print(f"WARNING: heartbeat '{heartbeat_id}' has no secret, every beat will be rejected "
+                      f"and it will go Offline (set heartbeat_secret or its 'secret')")
+            if target is None:
+                targets[heartbeat_id] = {"window": window, "secret": secret, "registered": now}
+            else:
+                target.update({"window": window, "secret": secret})
+
+
+def receive(payload, address):
+    """Validate a heartbeat payload and record it; returns True if it was accepted."""
+    if len(payload) > MAX_PAYLOAD_BYTES:
+        return False
+    try:
+        heartbeat_id, timestamp, signature = payload.decode("utf-8").strip().split("|")
+        beat_time = float(timestamp)
+    except ValueError:
+        return False
+    if not math.isfinite(beat_time):
+        return False  # NaN compares False both ways, so it would get past the skew and replay checks
+
+    now = time.time()
+    with heartbeat_lock:
+        target = targets.get(heartbeat_id)
+        if target is None or not target["secret"]:
+            return False
+        if not hmac.compare_digest(sign(heartbeat_id, timestamp, target["secret"]), signature.lower()):
+            return False
+        if abs(now - beat_time) > MAX_CLOCK_SKEW:
+            return False
+        previous = last_beats.get(heartbeat_id)
+        if previous is not None and beat_time <= previous[0]:
+            return False
+
+        last_beats[heartbeat_id] = (beat_time, now, address)
+        # Deadlines use the monotonic clock so a wall-clock step can't keep a target alive
+        wheel.schedule(heartbeat_id, time.monotonic() + target["window"])
+    return True
+
+
+def get_status(heartbeat_id, now=None):
+    """Return True if the target beat within its window, False if it didn't, None if it's too early to say.
+
+    A target that hasn't beaten since the monitor started is only reported once a full
+    window has passed, so restarts don't flag every agent as Offline. now is a time.monotonic() value.
+    """
+    now = time.monotonic() if now is None else now
+    with heartbeat_lock:
+        wheel.advance(now)
+        if heartbeat_id in wheel:
+            return True
+        target = targets.get(heartbeat_id)
+        if target is None or (heartbeat_id not in last_beats and now - target["registered"] < target["window"]):
+            return None
+        return False
+
+
+def get_last_beat(heartbeat_id):
+    """Return (beat time, received time, source address) of the last accepted beat, or None."""
+    with heartbeat_lock:
+        return last_beats.get(heartbeat_id)
+
+
+def serve_udp(sock):
+    while True:
+        try:
+            payload, address = sock.recvfrom(MAX_PAYLOAD_BYTES + 1)
+            receive(payload, address[0])
+        except Exception as e:
+            print(f"Heartbeat listener error: {e}")
+
+
+def start_udp_listener(host, port):
+    """Listen for heartbeat datagrams on a background thread."""
+    global listening
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    threading.Thread(target=serve_udp, args=(sock,), name="heartbeat-udp", daemon=True).start()
+    listening = True
+    print(f"Heartbeat listener on udp://{host}:{sock.getsockname()[1]}")
+    return sock
+
+
+class HeartbeatRequestHandler(BaseHTTPRequestHandler):
+    """Accept heartbeats POSTed to /heartbeat."""
+
+    timeout = 5  # Seconds; a client that never sends its body can't hold a thread
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/heartbeat":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_error(400)
+            return
+        if length < 0:
+            self.send_error(400)
+            return
+        if length > MAX_PAYLOAD_BYTES:
+            self.send_error(413)
+            return
+        accepted = receive(self.rfile.read(length), self.client_address[0])
+        self.send_response(204 if accepted else 403)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # One request per agent per interval would drown the monitor's output
+
+
+def start_http_listener(host, port):
+    """Accept heartbeats over HTTP on a background thread."""
+    global listening
+    server = ThreadingHTTPServer((host, port), HeartbeatRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="heartbeat-http", daemon=True).start()
+    listening = True
+    print(f"Heartbeat listener on http://{host}:{server.server_address[1]}/heartbeat")
+    return server
@@ -0,0 +1,166 @@
+import argparse
+import json
+import math
+import os
+import re
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Append-only history of every check result. Each check is a fixed-size little-endian record
+# (timestamp, target string id, status string id, response time in ms or NaN) in files named
+# checks-YYYYMMDD-NNN.bin, rotated daily and whenever a file reaches its size limit. Target ids
+# and statuses are stored once in strings.jsonl, where a string's id is its line number.
+RECORD = struct.Struct("<dIIf")
+STRINGS_FILE = "strings.jsonl"
+DATA_FILE_PATTERN = re.compile(r"^checks-(\d{8})-(\d{3})\.bin$")
+DEFAULT_MAX_FILE_BYTES = 8 * 1024 * 1024
+
+history_lock = threading.Lock()
+
+
+def load_strings(directory):
+    """Return the directory's strings as a list indexed by id."""
+    try:
+        with open(os.path.join(directory, STRINGS_FILE), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def get_string_ids(directory, strings):
+    """Return the ids for the given strings, appending any new ones to strings.jsonl."""
+    # Re-read the (small) table every time so ids stay consistent with other writers
+    table = {string: i for i, string in enumerate(load_strings(directory))}
+
+    new_strings = []
+    for string in strings:
+        if string not in table:
+            table[string] = len(table)
+            new_strings.append(string)
+    if new_strings:
+        with open(os.path.join(directory, STRINGS_FILE), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(string) + "\n" for string in new_strings))
+    return [table[string] for string in strings]
+
+
+def data_files(directory):
+    """Return (day, sequence, path) for every data file in the directory, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    files = []
+    for name in names:
+        match = DATA_FILE_PATTERN.match(name)
+        if match:
+            files.append((match.group(1), int(match.group(2)), os.path.join(directory, name)))
+    return sorted(files)
+
+
+def current_data_file(directory, day, max_file_bytes):
+    """Return the file to append today's records to, starting a new one once the last is full."""
+    sequence = 0
+    for file_day, file_sequence, path in data_files(directory):
+        if file_day == day:
+            sequence = file_sequence
+            if os.path.getsize(path) >= max_file_bytes:
+                sequence += 1
+    return os.path.join(directory, f"checks-{day}-{sequence:03d}.bin")
+
+
+def append_checks(directory, checks, max_file_bytes=DEFAULT_MAX_FILE_BYTES):
+    """Append (timestamp, target id, status, response time) checks with one write per file."""
+    if not checks:
+        return
+
+    with history_lock:
+        os.makedirs(directory, exist_ok=True)
+        by_day = {}
+        for check in checks:
+            day = datetime.fromtimestamp(check[0]).strftime("%Y%m%d")
+            by_day.setdefault(day, []).append(check)
+
+        for day, day_checks in by_day.items():
+            ids = get_string_ids(directory, [s for _, target, status, _ in day_checks for s in (target, status)])
+            data = b"".join(
+                RECORD.pack(timestamp, ids[2 * i], ids[2 * i + 1],
+                            math.nan if response_time is None else response_time)
+                for i, (timestamp, _, _, response_time) in enumerate(day_checks))
+            with open(current_data_file(directory, day, max_file_bytes), "ab") as f:
+                f.write(data)
+
+
+def read_checks(directory, start=None, end=None, targets=None):
+    """Yield (timestamp, target id, status, response time) for checks between start and end.
+
+    Only files whose day overlaps the window are read.
+    """
+    strings = load_strings(directory)
+    first_day = datetime.fromtimestamp(start).strftime("%Y%m%d") if start is not None else None
+    last_day = datetime.fromtimestamp(end).strftime("%Y%m%d") if end is not None else None
+    target_ids = None
+    if targets is not None:
+        targets = set(targets)
+        target_ids = {i for i, string in enumerate(strings) if string in targets}
+
+    for day, _, path in data_files(directory):
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % RECORD.size]  # Ignore a partially written last record
+        for timestamp, target, status, response_time in RECORD.iter_unpack(data):
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            if target_ids is not None and target not in target_ids:
+                continue
+            yield (timestamp, strings[target], strings[status],
+                   None if math.isnan(response_time) else response_time)
+
+
+def uptime(directory, start, end=None, targets=None, online="Online"):
+    """Return {target id: {"uptime": percent, "checks": n, "online_checks": n}} for a time window.
+
+    Uptime is time-weighted: each result holds until the target's next check (or the end of
+    the window), measured from the target's first check inside the window.
+    """
+    end = time.time() if end is None else end
+    checks = {}
+    for timestamp, target, status, _ in read_checks(directory, start, end, targets):
+        checks.setdefault(target, []).append((timestamp, status))
+
+    result = {}
+    for target, target_checks in checks.items():
+        target_checks.sort()
+        online_time = total_time = 0.0
+        for i, (timestamp, status) in enumerate(target_checks):
+            until = target_checks[i + 1][0] if i + 1 < len(target_checks) else end
+            total_time += until - timestamp
+            if status == online:
+                online_time += until - timestamp
+        online_checks = sum(1 for _, status in target_checks if status == online)
+        if total_time > 0:
+            percent = 100.0 * online_time / total_time
+        else:
+            percent = 100.0 * online_checks / len(target_checks)
+        result[target] = {"uptime": percent, "checks": len(target_checks), "online_checks": online_checks}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show uptime from the device monitor's check history.")
+    parser.add_argument("directory", help="History directory (history_dir in local_config)")
+    parser.add_argument("--hours", type=float, default=24, help="Size of the window ending now (default 24)")
+    parser.add_argument("--target", action="append", help="Only show this target id (repeatable)")
+    args = parser.parse_args()
+
+    start = (datetime.now() - timedelta(hours=args.hours)).timestamp()
+    stats = uptime(args.directory, start, targets=args.target)
+    for target, target_stats in sorted(stats.items()):
+        print(f"{target_stats['uptime']:7.3f}%  {target_stats['online_checks']}/{target_stats['checks']}  {target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,21 @@ devices = {
             {
                 'name': 'Example URL',
                 'value': 'https://example.com',
+            }, {
+                'name': 'Example URL, timing DNS/connect/TLS/first byte and checking the certificate',
+                'value': 'https://example.com/health',
+                'timing': True,
+                'cert_warning_days': 30,  # Optional, defaults to cert_expiry_warning_days
+            }, {
+                'name': 'Example URL, Online only if the response body checks out',
+                'value': 'https://example.com/api/health',
+                # Any of: 'contains', 'regex', 'json_path' (+ optional 'json_equals'), 'max_bytes'.
+                # The body is streamed and reading stops once the result is known or after max_bytes.
+                'expect': {
+                    'json_path': 'status.database',
+                    'json_equals': 'up',
+                    'max_bytes': 64 * 1024,
+                },
             }
         ],
         "ips": [
@@ -26,6 +41,26 @@ devices = {
                 'value': '/example/directory',
             }
         ],
+        # Agents that push heartbeats instead of being polled (needs check_interval and a listener).
+        # 'value' is the id the agent sends; Offline when no valid beat arrives within 'window' seconds.
+        "heartbeats": [
+            {
+                'name': 'Example Agent',
+                'value': 'example-agent',
+                'window': 300,
+            }
+        ],
+    },
+    # A device behind another one: while every resource of its parent is down, its resources are
+    # recorded as "Unreachable (parent down)" without being probed
+    "ExampleSwitch": {
+        "parent": "ExampleDevice",
+        "ips": [
+            {
+                'name': 'Switch IP',
+                'value': '192.168.1.2'
+            },
+        ],
     },
 }
 
@@ -53,3 +88,76 @@ google_credentials = {
 }
 google_sheet_id = "YOUR_GOOGLE_SHEET_ID"           # Replace with your Google Sheet ID
 google_sheet_name = "Device Status"                # Name of the sheet/tab within the Google Sheet
+
+# Files the monitor keeps between runs (defaults to a .device_monitor folder next to the code)
+# state_dir = "/var/lib/device-monitor"
+# Local copy of the sheet, reused while the sheet's modified time is unchanged. Set to None to disable.
+# snapshot_file = "/var/lib/device-monitor/sheet_snapshot.json.gz"
+
+# Keep running and check every N seconds instead of checking once and exiting. While running,
+# edits to this file are picked up within a second: new or changed resources are checked right
+# away and everything else keeps its state (listener ports still need a restart)
+# check_interval = 300
+# Read-only status page (/) and JSON (/status.json) served while check_interval is set
+# status_server_host = "127.0.0.1"
+# status_server_port = 8080
+
+# Warn when a timed URL check sees a TLS certificate expiring within this many days. Each one is
+# emailed about at most once a day, whether or not anything changed status in that run.
+# cert_expiry_warning_days = 14
+
+# Opt-in diagnostics written after each check run: spans for every probe, sheet call and email
+# as Chrome trace-event JSON (open in chrome://tracing or ui.perfetto.dev), and a cProfile dump
+# trace_file = "device_monitor_trace.json"
+# profile_file = "device_monitor.prof"
+
+# Append-only history of every check, rotated daily and by size (defaults to state_dir/history).
+# Set to None to disable. Show uptime with: python history.py <history_dir> --hours 24
+# history_dir = "/var/lib/device-monitor/history"
+# history_max_file_bytes = 8 * 1024 * 1024
+# Also append every check to this worksheet, in one API call per run
+# history_sheet_name = "History"
+
+# Heartbeat listeners, only started with check_interval. Agents send
+# "<id>|<unix time>|<hex HMAC-SHA256 of '<id>|<unix time>' keyed with the secret>"
+# as a UDP datagram or as the body of a POST to /heartbeat, e.g.:
+#   ts=$(date +%s); sig=$(printf '%s' "example-agent|$ts" | openssl dgst -sha256 -hmac "$SECRET" | cut -d' ' -f2)
+#   curl -d "example-agent|$ts|$sig" http://monitor:8081/heartbeat
+# heartbeat_secret = "change-me"
+# heartbeat_host = "0.0.0.0"
+# heartbeat_udp_port = 8081
+# heartbeat_http_port = 8081
+
+# Probe engine: probes run concurrently, but never more than max_probes_per_host at once against
+# one host or max_probes_per_subnet into one subnet (/subnet_prefix_v4, /64 for IPv6), and new
+# probes of a host start at most probes_per_host_per_second. Set probe_workers = 1 to probe one at a time.
+# probe_workers = 16
+# max_probes_per_host = 2
+# max_probes_per_subnet = 8
+# probes_per_host_per_second = 5
+# subnet_prefix_v4 = 24
+# Spread probe start times over this many seconds (e.g. most of check_interval) instead of
+# starting them all at once; each target keeps a stable, jittered slot. With parent devices, each
+# dependency level gets a share of it in proportion to its size, starting once its parents are done
+# probe_spread = 240
+
+# Linux only: read the kernel's neighbor (ARP/NDP) table once per run and count IPs it has as
+# REACHABLE as Online without pinging them; stale or missing entries are still pinged
+# passive_presence = True
+
+# Back off resources that stay Offline: after backoff_after seconds down, the gap between full
+# checks grows with the outage (doubling every check) up to backoff_max_interval. In between, a
+# cheap recovery probe runs every backoff_recovery_interval: a ping (or port check) or, for URLs,
+# a TCP connect with backoff_probe_timeout, followed by the full check if it gets through.
+# Everything resets as soon as the resource is back Online.
+# backoff_after = 3600          # None disables backoff
+# backoff_max_interval = 6 * 3600
+# backoff_recovery_interval = 600   # None for full checks only
+# backoff_probe_timeout = 1
+
+# Only one run works at a time (cron, check_interval or by hand): a run waits up to run_lock_timeout
+# seconds for the one in progress and is skipped if it's still going. A run that had to wait reuses
+# the results the other run got meanwhile, if younger than reuse_results_for seconds, instead of
+# probing, writing or emailing them again. `python main.py --reuse-recent` reuses any that young.
+# run_lock_timeout = 600
+# reuse_results_for = 60        # 0 always probes
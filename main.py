@@ -1,9 +1,122 @@
+import argparse
+import time
+import cProfile
+import pstats
+import local_config
 import device_monitor as dm
+import heartbeat
+import tracing
+
+CONFIG_POLL_INTERVAL = 1  # Seconds between checks of local_config.py for changes while waiting
+
+
+def load_settings():
+    global check_interval, status_server_host, status_server_port
+    global heartbeat_host, heartbeat_udp_port, heartbeat_http_port, trace_file, profile_file
+
+    # Seconds between checks; leave unset to check once and exit (e.g. when run from cron)
+    check_interval = getattr(local_config, "check_interval", None)
+    # Port for the read-only status page and JSON API, only used with check_interval
+    status_server_host = getattr(local_config, "status_server_host", "127.0.0.1")
+    status_server_port = getattr(local_config, "status_server_port", None)
+    # Listeners for agents that push heartbeats instead of being polled, only used with check_interval
+    heartbeat_host = getattr(local_config, "heartbeat_host", "0.0.0.0")
+    heartbeat_udp_port = getattr(local_config, "heartbeat_udp_port", None)
+    heartbeat_http_port = getattr(local_config, "heartbeat_http_port", None)
+    # Opt-in diagnostics, rewritten after every check run: Chrome trace-event JSON and a cProfile dump
+    trace_file = getattr(local_config, "trace_file", None)
+    profile_file = getattr(local_config, "profile_file", None)
+
+
+load_settings()
+
+
+def run_checks(only=None, reuse_recent=False):
+    # Only one run at a time, so overlapping runs don't race on the sheet or send the same email twice
+    if not dm.acquire_run_lock(dm.run_lock_timeout):
+        print("Another run is still in progress, skipping this one.")
+        return
+    # A run that is on time probes everything; one that had to wait only needs to redo what the
+    # other run didn't get to while it waited
+    reuse_since = 0 if reuse_recent else dm.run_lock_wait_start
+    try:
+        run_locked_checks(only, reuse_since)
+    finally:
+        dm.release_run_lock()
+
+
+def run_locked_checks(only, reuse_since):
+    if trace_file:
+        tracing.start()
+    profiler = cProfile.Profile() if profile_file else None
+    if profiler:
+        # Probes run on executor threads, which get profilers of their own
+        dm.probe_profilers.clear()
+        dm.profile_probes = True
+        profiler.enable()
+
+    try:
+        with tracing.span("check_devices"):
+            offline_devices, online_devices = dm.check_devices(only, reuse_since)
+        with tracing.span("send_summary_email", offline=len(offline_devices), online=len(online_devices)):
+            dm.send_summary_email(offline_devices, online_devices)
+    finally:
+        if profiler:
+            profiler.disable()
+            dm.profile_probes = False
+            stats = pstats.Stats(profiler)
+            for probe_profiler in dm.probe_profilers:
+                stats.add(probe_profiler)
+            stats.dump_stats(profile_file)
+            print(f"Profile written to {profile_file}")
+        if trace_file:
+            tracing.stop()
+            tracing.write_trace(trace_file)
 
 
 def main():
-    offline_devices, online_devices = dm.check_devices()
-    dm.send_summary_email(offline_devices, online_devices)
+    parser = argparse.ArgumentParser(description="Check the configured devices and email any status changes.")
+    parser.add_argument("--reuse-recent", action="store_true",
+                        help="Reuse results other runs got within reuse_results_for seconds instead of probing again")
+    args = parser.parse_args()
+
+    if not check_interval:
+        run_checks(reuse_recent=args.reuse_recent)
+        return
+
+    if status_server_port is not None:
+        import status_server
+        status_server.start_status_server(status_server_host, status_server_port)
+    if heartbeat_udp_port is not None:
+        heartbeat.start_udp_listener(heartbeat_host, heartbeat_udp_port)
+    if heartbeat_http_port is not None:
+        heartbeat.start_http_listener(heartbeat_host, heartbeat_http_port)
+
+    interval = check_interval
+    reuse_recent = args.reuse_recent
+    while True:
+        started = time.time()
+        run_checks(reuse_recent=reuse_recent)
+        reuse_recent = False
+        wait_for_next_run(started + interval)
+        interval = check_interval or interval  # Switching to check-once mode needs a restart
+
+
+def wait_for_next_run(deadline):
+    """Sleep until the deadline, applying changes to local_config.py as soon as they are saved.
+
+    Added or changed targets are checked straight away; everything else keeps its schedule.
+    Listener ports only take effect after a restart.
+    """
+    while time.time() < deadline:
+        time.sleep(min(CONFIG_POLL_INTERVAL, max(0, deadline - time.time())))
+        if dm.config_changed():
+            changed = dm.reload_config()
+            if changed is None:
+                continue
+            load_settings()
+            if changed:
+                run_checks(changed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+import html
+import json
+import threading
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import device_monitor as dm
+
+# Part of every ETag so a client's cached copy from an earlier process never matches
+BOOT_ID = uuid.uuid4().hex[:8]
+
+render_lock = threading.Lock()
+rendered = {}  # Route -> (version, body), rebuilt only when the monitor state changes
+
+
+def format_time(timestamp):
+    """Format an epoch timestamp the same way the Google Sheet does."""
+    if not timestamp:
+        return ""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %I:%M:%S %p')
+
+
+def render_json(status):
+    return json.dumps(status, separators=(",", ":")).encode("utf-8")
+
+
+def render_html(status):
+    """Render a minimal status page from the status snapshot."""
+    rows = []
+    for target in sorted(status["targets"], key=lambda t: (t["device"], t["type"], t["resource"])):
+        latency = target["latency"]
+        rows.append(
+            "<tr class='{cls}'><td>{device}</td><td>{resource}</td><td>{type}</td><td>{value}</td>"
+            "<td>{status}</td><td>{last}</td><td>{avg}</td><td>{p95}</td><td>{since}</td></tr>".format(
+                cls="online" if target["status"] == dm.ONLINE else "offline",
+                device=html.escape(target["device"]),
+                resource=html.escape(target["resource"]),
+                type=html.escape(target["type"]),
+                value=html.escape(str(target["value"])),
+                status=html.escape(str(target["status"])),
+                last=f"{target['response_time']:.2f}ms" if target["response_time"] is not None else "",
+                avg=f"{latency['avg']:.2f}ms" if latency else "",
+                p95=f"{latency['p95']:.2f}ms" if latency else "",
+                since=format_time(target["since"]),
+            ))
+
+    transitions = []
+    for transition in reversed(status["transitions"]):
+        transitions.append("<li>{time} - {device} - {resource} ({type}): {old} &rarr; {new}</li>".format(
+            time=format_time(transition["time"]),
+            device=html.escape(transition["device"]),
+            resource=html.escape(transition["resource"]),
+            type=html.escape(transition["type"]),
+            old=html.escape(str(transition["from"])),
+            new=html.escape(str(transition["to"])),
+        ))
+
+    page = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Device Monitor</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 2px 6px; text-align: left; }}
+tr.online td {{ background: #e6f4e6; }}
+tr.offline td {{ background: #f8e0e0; }}
+</style></head>
+<body>
+<h1>Device Monitor</h1>
+<p>Generated {generated} - <a href="/status.json">JSON</a></p>
+<table>
+<tr><th>Device</th><th>Resource</th><th>Type</th><th>Value</th><th>Status</th>
+<th>Last</th><th>Avg</th><th>P95</th><th>Since</th></tr>
+{rows}
+</table>
+<h2>Recent transitions</h2>
+<ul>
+{transitions}
+</ul>
+</body></html>
+""".format(generated=format_time(status["generated"]), rows="\n".join(rows), transitions="\n".join(transitions))
+    return page.encode("utf-8")
+
+
+ROUTES = {
+    "/": ("text/html; charset=utf-8", render_html),
+    "/status.json": ("application/json", render_json),
+}
+
+
+def get_rendered(path):
+    """Return (etag, body) for a route, rendering it only if the state changed since last time."""
+    version = dm.state_version
+    with render_lock:
+        cached = rendered.get(path)
+        if cached is None or cached[0] != version:
+            version, status = dm.get_status_snapshot()
+            cached = rendered[path] = (version, ROUTES[path][1](status))
+        return f'"{BOOT_ID}-{cached[0]}"', cached[1]
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """Serve the status page and JSON; GET and HEAD only."""
+
+    def do_GET(self):
+        self.respond(include_body=True)
+
+    def do_HEAD(self):
+        self.respond(include_body=False)
+
+    def respond(self, include_body):
+        path = self.path.split("?", 1)[0]
+        if path not in ROUTES:
+            self.send_error(404)
+            return
+
+        # Answer a matching conditional request without rendering anything
+        etag = f'"{BOOT_ID}-{dm.state_version}"'
+        if etag in self.if_none_match():
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+
+        etag, body = get_rendered(path)
+        self.send_response(200)
+        self.send_header("Content-Type", ROUTES[path][0])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
+
+    def if_none_match(self):
+        header = self.headers.get("If-None-Match", "")
+        return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+    def log_message(self, format, *args):
+        pass  # Dashboards poll frequently, keep them out of the monitor's output
+
+
+def start_status_server(host, port):
+    """Start the status server on a background thread and return it."""
+    server = ThreadingHTTPServer((host, port), StatusRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="status-server", daemon=True)
+    thread.start()
+    print(f"Status server listening on http://{host}:{server.server_address[1]}/")
+    return server
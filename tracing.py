@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Spans are only recorded while enabled; otherwise span() costs next to nothing
+enabled = False
+events = []
+events_lock = threading.Lock()
+trace_start = time.perf_counter()
+
+
+def start():
+    """Enable tracing and drop any spans from a previous cycle."""
+    global enabled, trace_start
+    with events_lock:
+        events.clear()
+    trace_start = time.perf_counter()
+    enabled = True
+
+
+def stop():
+    global enabled
+    enabled = False
+
+
+@contextmanager
+def span(name, category="monitor", **args):
+    """Record the enclosed block as a complete ("X") trace event.
+
+    Yields the event's args dict so attributes known only at the end (a status, a
+    response time) can be added inside the block.
+    """
+    if not enabled:
+        yield {}
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end_time = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start_time - trace_start) * 1e6,  # Trace events use microseconds
+            "dur": (end_time - start_time) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with events_lock:
+            events.append(event)
+
+
+def write_trace(path):
+    """Write the recorded spans as Chrome trace-event JSON (chrome://tracing, Perfetto, speedscope)."""
+    with events_lock:
+        trace_events = list(events)
+
+    # Name the threads so concurrent probes are easy to tell apart in the viewer
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for tid in sorted({event["tid"] for event in trace_events}):
+        trace_events.append({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": thread_names.get(tid, str(tid))},
+        })
+
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        print(f"Trace written to {path} ({len(events)} spans)")
+    except Exception as e:
+        print(f"Failed to write trace {path}: {e}")